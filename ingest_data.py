@@ -1,7 +1,7 @@
 
 import pandas as pd
 import numpy as np
-from pandas.core.dtypes.common import _get_dtype_from_object
+from pandas.api.types import pandas_dtype
 
 def matches_dtypes(df, dtypes):
     """
@@ -22,9 +22,13 @@ def matches_dtypes(df, dtypes):
     * To select Pandas datetimetz dtypes, use 'datetimetz' (new in 0.20.0),
       or a 'datetime64[ns, tz]' string
     """
-    dtypes = list(map(_get_dtype_from_object, dtypes))
+    # Abstract numpy types like np.number pass through as-is for the
+    # issubclass check; anything else goes via pandas_dtype
+    dtypes = [t if isinstance(t, type) and issubclass(t, np.generic)
+              else pandas_dtype(t).type
+              for t in dtypes]
     boolean_list = [any([issubclass(coltype.type,t) for t in dtypes])
-                     for (column,coltype) in df.dtypes.iteritems()]
+                     for (column,coltype) in df.dtypes.items()]
     return pd.Series(boolean_list, index=df.columns)
 
 # Guess unknown datatypes
@@ -43,7 +47,8 @@ def guess_datatypes(df, known_datatypes=None):
         raise ValueError("Unrecognised datatypes: {}".format(set(known_datatypes) - ALLOWED_VALUES))
 
     datatypes = pd.Series(known_datatypes, index=df.columns)
-    unknown = [t=='' for t in known_datatypes]
+    # Series, not list - newer pandas disallows list & Series logical ops
+    unknown = datatypes == ''
     looks_numeric = matches_dtypes(df, [np.number])
     # for now either numeric or categorical
     looks_categorical = ~looks_numeric
@@ -197,6 +202,11 @@ def parse_input(infile, separator=None, filetype='csv'):
     field_info['FieldType'] = field_info['FieldType'].map({'Q':'Numeric','N':'Categorical'})
     sample_info_types['InfoType'] = sample_info_types['InfoType'].map({'Q':'Numeric','N':'Categorical'})
 
+    # Precompute the type masks once at parse time, so downstream
+    # transforms don't rebuild them from FieldType on every callback
+    field_info['IsNumeric'] = field_info['FieldType']=='Numeric'
+    field_info['IsCategorical'] = field_info['FieldType'].isin(['OrderedCategorical','Categorical'])
+
     #print("Parse results:")
     #print("Data\n",data)
     #print("sample info",sample_info)
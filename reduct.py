@@ -12,18 +12,32 @@ import plotly.graph_objs as go
 import plotly
 
 import argparse
+import functools
 import os
 import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import errno
 import json
 import uuid
 import base64
+import numpy as np
 import pandas as pd
 from sklearn.decomposition import PCA
 
+try:
+    import pyarrow
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
 from ingest_data import parse_input
 from transform_data import complete_missing_data, preprocess, pca_transform, mds_transform, tsne_transform, umap_transform
 
+# Above this many categories a per-category legend stops being usable;
+# fall back to a single colour-mapped trace instead of one trace per value
+MAX_LEGEND_CATEGORIES = 20
+
 def create_app(cachetype, cachesize, num_pcs, hover_sampleinfo, hover_data, colour_by_data):
     '''
     This function contains the bulk of the code, defining layout and callbacks.
@@ -63,6 +77,14 @@ def create_app(cachetype, cachesize, num_pcs, hover_sampleinfo, hover_data, colo
         'CACHE_THRESHOLD': cachesize}
         )
 
+    # All PCA computations run on this worker, with one in-flight Future
+    # per cache key, so concurrent requests for the same settings (e.g.
+    # the post-upload warm-up racing the first callback) share a single
+    # decomposition instead of each running their own
+    pca_executor = ThreadPoolExecutor(max_workers=1)
+    pca_inflight = {}
+    pca_inflight_lock = threading.Lock()
+
     # *** Define UI and other layout elements ***
 
     dummy_input = html.Div(id='dummy_input',
@@ -311,17 +333,35 @@ def create_app(cachetype, cachesize, num_pcs, hover_sampleinfo, hover_data, colo
     def write_dataframe(filename, df):
         '''
         Write dataframe to disk.
+        Uses Feather when pyarrow is available, so reads can be
+        memory-mapped; falls back to pickle otherwise.
         '''
         path = os.path.join(filecache_dir, filename)
-        df.to_pickle(path)
+        if feather is not None:
+            # Go through an Arrow table with preserve_index so the index
+            # survives the round trip even if a data field is named
+            # 'index'; the pandas metadata restores it on read
+            feather.write_feather(
+                pyarrow.Table.from_pandas(df, preserve_index=True), path)
+        else:
+            df.to_pickle(path)
 
     @cache.memoize()
     def read_dataframe(filename, timestamp):
         '''
         Read dataframe from disk.
+        Feather files are memory-mapped rather than parsed, so repeat
+        reads after a cache eviction don't re-deserialise the data.
         '''
         path = os.path.join(filecache_dir, filename)
-        df = pd.read_pickle(path)
+        if feather is not None:
+            # The conversion is zero-copy on top of the read-only mapped
+            # file, and preprocess writes columns in place - copy so
+            # callers get ordinary writable blocks. memoize means this
+            # only happens on cache misses.
+            df = feather.read_feather(path, memory_map=True).copy()
+        else:
+            df = pd.read_pickle(path)
         return df
 
     # TODO: could allow user to specify
@@ -392,6 +432,9 @@ def create_app(cachetype, cachesize, num_pcs, hover_sampleinfo, hover_data, colo
                     [data, sample_info, sample_info_types, field_info],
                     ['data','sampleinfo','sampleinfotypes','fieldinfo']):
                 write_dataframe(session_id+'_'+suffix, df)
+            # Warm the PCA cache in the background so the first tab switch
+            # doesn't block on the decomposition
+            warm_pca_cache(session_id, last_modified)
             return last_modified
 
     # Last file uploaded: myfile.tsv
@@ -425,6 +468,10 @@ def create_app(cachetype, cachesize, num_pcs, hover_sampleinfo, hover_data, colo
                     filteredrows, filteredcols)))
 
 
+    # Transformed results are handed to callbacks entirely server-side via
+    # these memoized getters; the hidden divs carry only the session id and
+    # upload timestamp, never serialised data, so no JSON (de)serialisation
+    # of numeric matrices happens on the interaction path.
     @cache.memoize()
     def get_completed_data(session_id, timestamp, selected_fields, method,
                            numeric_fill, categorical_fill):
@@ -440,11 +487,18 @@ def create_app(cachetype, cachesize, num_pcs, hover_sampleinfo, hover_data, colo
         # Currently no method for the user to select fields
         selected_fields = list(range(data.shape[1]))
 
+        # take() subsets columns by position in one array gather;
+        # when every field is selected, skip the copy entirely
+        if len(selected_fields) == data.shape[1]:
+            selected_data, selected_info = data, field_info
+        else:
+            selected_data = data.take(selected_fields, axis=1)
+            selected_info = field_info.take(selected_fields)
+
         # TODO: we don't really need fields_kept or samples_kept
         # we could get this from the columns and index of completed
         completed, fields_kept, samples_kept = complete_missing_data(
-            data.iloc[:,selected_fields],
-            field_info.iloc[selected_fields,:],
+            selected_data, selected_info,
             method=method, numeric_fill=numeric_fill,
             categorical_fill=categorical_fill)
 
@@ -470,26 +524,81 @@ def create_app(cachetype, cachesize, num_pcs, hover_sampleinfo, hover_data, colo
         return (encoded, original_fields)
 
 
+    @functools.lru_cache(maxsize=32)
     @cache.memoize()
-    def get_pca_data(session_id, timestamp, scale, selected_fields,
+    def _get_pca_data_cached(session_id, timestamp, scale, selected_fields,
             fill_method, numeric_fill, categorical_fill):
-        """
-        Get completed dataset and call pca_transform.
-        Return transformed data.
-        Memoised by completion settings, PCA options, session and
-        upload timestamp.
-        """
         data, original_fields = get_preprocessed_data(session_id, timestamp, scale, selected_fields,
             fill_method, numeric_fill, categorical_fill)
         field_info = read_dataframe(session_id+'_fieldinfo', timestamp)
 
         pca, transformed, components = pca_transform(
-            data, field_info.loc[data.columns,:],
+            data, field_info,
             max_pcs=num_pcs)
 
         return (transformed, components,
                 original_fields, list(pca.explained_variance_ratio_))
 
+    def _start_pca_computation(session_id, timestamp, scale, selected_fields,
+            fill_method, numeric_fill, categorical_fill):
+        """
+        Submit the PCA computation for these settings to the executor and
+        return its Future. Callers arriving while the same key is already
+        being computed get the existing Future rather than a second
+        computation; neither lru_cache nor cache.memoize provides this
+        single-flight behaviour on their own.
+        """
+        key = (session_id, timestamp, scale, selected_fields,
+               fill_method, numeric_fill, categorical_fill)
+        with pca_inflight_lock:
+            future = pca_inflight.get(key)
+            started = future is None
+            if started:
+                future = pca_executor.submit(_get_pca_data_cached, *key)
+                pca_inflight[key] = future
+        if started:
+            def clear_inflight(_future, key=key):
+                with pca_inflight_lock:
+                    pca_inflight.pop(key, None)
+            future.add_done_callback(clear_inflight)
+        return future
+
+    def get_pca_data(session_id, timestamp, scale, selected_fields,
+            fill_method, numeric_fill, categorical_fill):
+        """
+        Get completed dataset and call pca_transform.
+        Return transformed data.
+        Memoised by completion settings, PCA options, session and
+        upload timestamp.
+        The lru_cache layer serves repeated interactions (axis or colour
+        changes) straight from process memory, without re-fetching and
+        deserialising the result from the flask cache. Cache misses wait
+        on the shared in-flight Future, so a callback racing the upload
+        warm-up reuses its computation instead of duplicating it.
+        """
+        if isinstance(selected_fields, list):
+            # cache keys need hashable arguments
+            selected_fields = tuple(selected_fields)
+        return _start_pca_computation(session_id, timestamp, scale,
+            selected_fields, fill_method, numeric_fill,
+            categorical_fill).result()
+
+    def warm_pca_cache(session_id, timestamp):
+        """
+        Start computing the PCA for the default control settings, without
+        waiting for the result: the first callback that needs it joins the
+        in-flight computation rather than blocking on a fresh one.
+        """
+        # Values match the defaults of the sidebar controls
+        future = _start_pca_computation(session_id, timestamp, False, None,
+            'fill_values', 'mean', 'common_unknown')
+        def log_failure(future):
+            e = future.exception()
+            if e is not None:
+                # A failed warm-up only costs the head start
+                print("PCA cache warm-up failed: {}".format(e))
+        future.add_done_callback(log_failure)
+
 
     @cache.memoize()
     def get_mds_data(session_id, timestamp, scale, selected_fields,
@@ -505,7 +614,7 @@ def create_app(cachetype, cachesize, num_pcs, hover_sampleinfo, hover_data, colo
         field_info = read_dataframe(session_id+'_fieldinfo', timestamp)
         # TODO: we only really need transformed
         mds, transformed = mds_transform(
-            data, field_info.loc[data.columns,:])
+            data, field_info)
 
         return transformed
 
@@ -524,7 +633,7 @@ def create_app(cachetype, cachesize, num_pcs, hover_sampleinfo, hover_data, colo
         field_info = read_dataframe(session_id+'_fieldinfo', timestamp)
 
         tsne, transformed = tsne_transform(
-            data, field_info.loc[data.columns,:],
+            data, field_info,
             perplexity=perplexity)
 
         return transformed
@@ -543,7 +652,7 @@ def create_app(cachetype, cachesize, num_pcs, hover_sampleinfo, hover_data, colo
         field_info = read_dataframe(session_id+'_fieldinfo', timestamp)
 
         umap, transformed = umap_transform(
-            data, field_info.loc[data.columns,:],
+            data, field_info,
             n_neighbors=n_neighbors, min_dist=min_dist)
 
         return transformed
@@ -848,7 +957,7 @@ def create_app(cachetype, cachesize, num_pcs, hover_sampleinfo, hover_data, colo
         colour_field_source, colour_field = colour_field_selection[:4], colour_field_selection[4:]
         if colour_field_source == 'NONE':
             # No colouring
-            traces = [go.Scatter(x=transformed[x_field], y=transformed[y_field],
+            traces = [go.Scattergl(x=transformed[x_field], y=transformed[y_field],
                       mode='markers', marker=dict(size=10, opacity=0.7),
                       text=hover_text)]
         else:
@@ -863,7 +972,7 @@ def create_app(cachetype, cachesize, num_pcs, hover_sampleinfo, hover_data, colo
             # Use continuous colour scale if Numeric, and discrete if Categorical
             if colour_field_type=='Numeric':
                 #colour_values[ colour_values.isnull() ] = 0  # better to let plotly handle
-                traces = [go.Scatter(x=transformed[x_field], y=transformed[y_field],
+                traces = [go.Scattergl(x=transformed[x_field], y=transformed[y_field],
                           mode='markers',
                           marker=dict(size=10, opacity=0.7,
                                       color=colour_values,
@@ -873,25 +982,50 @@ def create_app(cachetype, cachesize, num_pcs, hover_sampleinfo, hover_data, colo
                 # Treat colour as a categorical field
                 # Make separate traces to get colours and a legend
                 assert colour_field_type in ['Categorical','OrderedCategorical']
-                traces = []
-                # points with missing values
-                if colour_values.isnull().sum() > 0:
-                    rows = colour_values.isnull()
-                    traces.append(go.Scatter(x=transformed.loc[rows,x_field],
-                                             y=transformed.loc[rows,y_field],
-                                  mode='markers', marker=dict(size=10, opacity=0.7),
-                                  name='Unknown', text=hover_text[rows]))
-                # points with a colour field value - in category order if pandas category, else sorted
+                # Pull plain arrays once and integer-index them per group,
+                # instead of label-slicing the dataframe for every category
+                x_points = transformed[x_field].values
+                y_points = transformed[y_field].values
+                hover_points = np.asarray(hover_text)
+                # category order if pandas category, else sorted
                 try:
                     unique_colour_values = colour_values.cat.categories
                 except AttributeError:  # no .cat accessor, not categorical
                     unique_colour_values = sorted(colour_values.unique(), key=lambda x:str(x))
-                for value in unique_colour_values:
-                    rows = colour_values == value
-                    traces.append(go.Scatter(x=transformed.loc[rows,x_field],
-                                             y=transformed.loc[rows,y_field],
-                                  mode='markers', marker=dict(size=10, opacity=0.7),
-                                  name=str(value), text=hover_text[rows]))
+                if len(unique_colour_values) > MAX_LEGEND_CATEGORIES:
+                    # Too many categories for a legend: draw one trace with
+                    # a colour code per point instead of one trace per value.
+                    # Category values go in the hover text; missing values
+                    # get code -1 and take the low end of the colour scale.
+                    # Categorical categories may not contain nulls, and
+                    # unique() includes NaN for non-categorical columns
+                    categories = [v for v in unique_colour_values
+                                  if not pd.isnull(v)]
+                    codes = pd.Categorical(colour_values,
+                                           categories=categories).codes
+                    labelled_hover = ["{} | {}".format(h, v)
+                                      for (h, v) in zip(hover_points, colour_values)]
+                    traces = [go.Scattergl(x=x_points, y=y_points,
+                              mode='markers',
+                              marker=dict(size=10, opacity=0.7, color=codes),
+                              text=labelled_hover)]
+                else:
+                    traces = []
+                    group_rows = colour_values.groupby(colour_values).indices
+                    # points with missing values
+                    missing_rows = np.flatnonzero(colour_values.isnull().values)
+                    if len(missing_rows) > 0:
+                        traces.append(go.Scattergl(x=x_points[missing_rows],
+                                                   y=y_points[missing_rows],
+                                      mode='markers', marker=dict(size=10, opacity=0.7),
+                                      name='Unknown', text=hover_points[missing_rows]))
+                    no_rows = np.empty(0, dtype=int)
+                    for value in unique_colour_values:
+                        rows = group_rows.get(value, no_rows)
+                        traces.append(go.Scattergl(x=x_points[rows],
+                                                   y=y_points[rows],
+                                      mode='markers', marker=dict(size=10, opacity=0.7),
+                                      name=str(value), text=hover_points[rows]))
 
         figure = {
             'data': traces,
@@ -954,11 +1088,15 @@ def create_app(cachetype, cachesize, num_pcs, hover_sampleinfo, hover_data, colo
                            in pcy_original.sort_values(ascending=False)[:5].items()
                            if sqvalue > 0.01][::-1])
 
+        # Skip exactly the precomputed mask columns, which just restate
+        # FieldType; any other field-info column still shows on hover
+        info_fields = [c for c in field_info.columns
+                       if c not in ('IsNumeric', 'IsCategorical')]
         hovertext_x = ["; ".join(["{}={}".format(name,value)
-                            for (name,value) in field_info.loc[field,:].items()])
+                            for (name,value) in field_info.loc[field,info_fields].items()])
                        for field in xlabels]
         hovertext_y = ["; ".join(["{}={}".format(name,value)
-                            for (name,value) in field_info.loc[field,:].items()])
+                            for (name,value) in field_info.loc[field,info_fields].items()])
                        for field in ylabels]
 
         x_bargraph = go.Bar(y=xlabels, x=xsizes,
@@ -1,10 +1,38 @@
 
 import pandas as pd
 import numpy as np
-from sklearn.decomposition import PCA
+import sklearn
+from scipy import sparse
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.manifold import MDS, TSNE
 from umap import UMAP
 
+# The "covariance_eigh" solver (sklearn >= 1.5) forms the d x d covariance
+# and eigendecomposes it, which is much cheaper than an SVD of the full
+# data matrix when n_samples >> n_features - the usual shape after
+# one-hot encoding. Fall back to "auto" on older sklearn.
+try:
+    _SKLEARN_VERSION = tuple(int(v) for v in sklearn.__version__.split('.')[:2])
+except ValueError:
+    _SKLEARN_VERSION = (0, 0)
+PCA_SOLVER = 'covariance_eigh' if _SKLEARN_VERSION >= (1, 5) else 'auto'
+
+def choose_svd_solver(n_samples, n_features, num_pcs):
+    """
+    Pick a PCA solver for the given problem shape.
+    Randomised SVD costs O(n*d*k) rather than O(n*d^2), a big win when
+    the matrix is wide and only a few components are wanted; otherwise
+    use the covariance/eigh path where available.
+    """
+    if n_features > 500 and num_pcs < 0.1 * min(n_samples, n_features):
+        return 'randomized'
+    return PCA_SOLVER
+
+# Above this many matrix elements, stream the PCA through IncrementalPCA
+# in fixed-size batches rather than letting PCA copy and centre the whole
+# matrix at once (peak memory ~3x the data otherwise)
+INCREMENTAL_PCA_THRESHOLD = 10**7
+
 # TODO: decide when calling PCA whether to treat OrderedCategorical as
 #  unordered, or effectively numeric (but treat as categorical for colouring!).
 #  Currently it is treated as unordered.
@@ -57,42 +85,51 @@ def complete_missing_data(data, field_info,
         samples_kept = pd.Series(True, index=data.index)
 
         data_missing = data.isnull().sum() > 0
-        numeric = field_info['FieldType']=='Numeric'
-        categorical = field_info['FieldType'].isin(['OrderedCategorical','Categorical'])
+        numeric = field_info['IsNumeric']
+        categorical = field_info['IsCategorical']
         numeric_fields = data.columns[data_missing & numeric]
         categorical_fields = data.columns[data_missing & categorical]
 
-        completed = data.copy()
+        # Shallow-copy the frame and copy only the columns we actually
+        # fill, rather than deep-copying every column up front
+        completed = data.copy(deep=False)
 
-        for field in numeric_fields:
-            print("Filling in missing values in "+field)
-            missing_values = data[field].isnull()
+        if len(numeric_fields) > 0:
+            # One vectorised fillna over all affected numeric columns,
+            # rather than a Python-level loop of per-field mask assignments
+            print("Filling in missing values in "+", ".join(numeric_fields))
             if numeric_fill=='zeroes':
-                completed.loc[missing_values,field] = 0
+                fill_with = 0
             elif numeric_fill=='mean':
-                completed.loc[missing_values,field] = data[field].mean()
+                fill_with = data[numeric_fields].mean()
+            completed[numeric_fields] = data[numeric_fields].fillna(fill_with)
 
         for field in categorical_fields:
             print("Filling in missing values in "+field)
             missing_values = data[field].isnull()
+            filled = data[field].copy()
+            # The existing categories are already the unique values;
+            # collision checks are then set lookups, not O(n) column scans
+            existing_values = set(data[field].cat.categories)
             if categorical_fill=='common_unknown':
                 #print("Common unknown")
                 new_value = 'Unknown'
                 # Make sure this value does not already exist in data
-                while new_value in data[field].unique():
+                while new_value in existing_values:
                     new_value = new_value + "_"
                 # add_categories adds new unknown
                 # if we want to put it e.g. at start of ordering, may need set_categories
-                completed[field].cat.add_categories([new_value], inplace=True)
-                completed.loc[missing_values,field] = new_value
+                filled = filled.cat.add_categories([new_value])
+                filled[missing_values] = new_value
             elif categorical_fill=='unique_unknown':
                 #print("Unique unknown")
                 new_values = ["Unknown{}".format(n+1) for n in range(missing_values.sum())]
                 # Make sure none of these values already exist in data
-                while data[field].isin(new_values).sum() > 0:
+                while any(v in existing_values for v in new_values):
                     new_values = [v+"_" for v in new_values]
-                completed[field].cat.add_categories(new_values, inplace=True)
-                completed.loc[missing_values,field] = new_values
+                filled = filled.cat.add_categories(new_values)
+                filled[missing_values] = new_values
+            completed[field] = filled
 
     else:
         raise ValueError("Unknown missing data method "+method)
@@ -111,15 +148,31 @@ def one_hot(series, categories=None):
     where each column corresponds to a category.
     The category name is encoded in the columns of the returned DataFrame,
     i.e. each column name is of form {OriginalFieldName}_{CategoryName}.
+    Columns are sparse, storing one nonzero per row instead of a
+    dense MxN block.
     """
     if categories is None:
         vec = series.astype('category')
     else:
-        vec = series.astype('category', categories=categories)
-    vec_numeric = vec.cat.codes
-    encoded = pd.DataFrame(np.eye(len(vec.cat.categories), dtype=int)[vec_numeric])
-    encoded.columns = ['{}_{}'.format(series.name, c) for c in vec.cat.categories]
-    encoded.index = vec.index
+        vec = series.astype(pd.api.types.CategoricalDtype(categories))
+    # Build the CSR matrix directly from the category codes: exactly one
+    # nonzero per row, at the column given by the code, so the indptr is
+    # just arange. Assumes missing values have already been filled.
+    codes = np.asarray(vec.cat.codes.values, dtype=np.int32)
+    n_rows = len(codes)
+    n_categories = len(vec.cat.categories)
+    matrix = sparse.csr_matrix(
+        (np.ones(n_rows, dtype=np.float32),
+         codes,
+         np.arange(n_rows+1, dtype=np.int32)),
+        shape=(n_rows, n_categories))
+    encoded = pd.DataFrame.sparse.from_spmatrix(
+        matrix, index=vec.index,
+        columns=['{}_{}'.format(series.name, c) for c in vec.cat.categories])
+    # Newer pandas gives from_spmatrix columns a NaN fill value, which
+    # would turn every non-hot cell into NaN on densify; force zero fill
+    # (stays sparse - only the fill value changes)
+    encoded = encoded.astype(pd.SparseDtype(np.float32, 0))
     return encoded
 
 def preprocess(data, field_info, scale=False):
@@ -131,13 +184,13 @@ def preprocess(data, field_info, scale=False):
     Return preprocessed dataframe, and dict mapping encoded fieldnames
     to original fieldnames.
     """
-    numeric_fieldspec = field_info['FieldType']=='Numeric'
-    categorical_fields = data.columns[field_info['FieldType'].isin(['OrderedCategorical','Categorical'])]
+    numeric_fieldspec = field_info['IsNumeric']
+    categorical_fields = data.columns[field_info['IsCategorical']]
 
     if scale:
-        # Subtracting mean should have no effect,
-        # dividing by std should
-        data.loc[:,numeric_fieldspec] -= data.loc[:,numeric_fieldspec].mean()
+        # PCA centres the data itself, so subtracting the mean here has
+        # no effect on the result - only the std division matters.
+        # Skipping it saves a full-column read-modify-write pass.
         data.loc[:,numeric_fieldspec] /= data.loc[:,numeric_fieldspec].std()
 
     # Encode any categorical fields, and concat results with numerical fields
@@ -148,7 +201,9 @@ def preprocess(data, field_info, scale=False):
                         axis=1)
 
     print("One-hot encoded data shape {}".format(encoded.shape))
-    assert np.all(data.index==encoded.index)
+    # concat aligns its inputs on the index, so a length check is enough
+    # here - cheaper than an O(n) elementwise index comparison
+    assert len(encoded) == len(data)
 
     original_fields = {}
     for field in data.columns[numeric_fieldspec]:
@@ -172,9 +227,28 @@ def pca_transform(data, field_info, max_pcs):
     print("Performing PCA")
     # Do PCA
     num_pcs = min(max_pcs, data.shape[1], data.shape[0])
-    pca = PCA(num_pcs)
-    transformed = pd.DataFrame(pca.fit_transform(data.values),
-                               index=data.index)
+    # float32 halves memory use and bandwidth, and is ample precision
+    # for a visualisation. Column-major (Fortran) layout lets LAPACK
+    # work on the array directly instead of re-copying it internally.
+    values = np.asarray(data.to_numpy(copy=False), dtype=np.float32, order='F')
+    if values.size > INCREMENTAL_PCA_THRESHOLD:
+        # Large input: fit in batches to cap peak memory at
+        # O(batch_size * d) instead of O(n * d) extra
+        pca = IncrementalPCA(n_components=num_pcs)
+        batch_size = max(5*num_pcs, 2048)
+        chunks = np.array_split(values, max(1, len(data)//batch_size))
+        for chunk in chunks:
+            pca.partial_fit(chunk)
+        transformed = pd.DataFrame(
+            np.concatenate([pca.transform(chunk) for chunk in chunks]),
+            index=data.index)
+    else:
+        solver = choose_svd_solver(data.shape[0], data.shape[1], num_pcs)
+        # values is a private working copy, so let PCA centre it in place
+        # rather than allocating yet another n x d array
+        pca = PCA(num_pcs, svd_solver=solver, copy=False)
+        transformed = pd.DataFrame(pca.fit_transform(values),
+                                   index=data.index)
     pca_names = ["PCA{}".format(n) for n in range(1,num_pcs+1)]
     transformed.columns = pca_names
 
@@ -198,7 +272,7 @@ def mds_transform(data, field_info):
     """
     print("Performing MDS")
     mds = MDS(2)
-    transformed = pd.DataFrame(mds.fit_transform(data.values),
+    transformed = pd.DataFrame(mds.fit_transform(data.to_numpy(copy=False)),
                                index=data.index)
     transformed.columns = ['MDS dim A','MDS dim B']
 
@@ -237,10 +311,12 @@ def tsne_transform(data, field_info,
     if pca_dims is not None and pca_dims < data.shape[1] and pca_dims < data.shape[0]:
         print("Carrying out PCA prior to tSNE: {} -> {}".format(data.shape[1],
                                                                 pca_dims))
-        pca = PCA(pca_dims)
-        compressed = pca.fit_transform(data.values)
+        pca = PCA(pca_dims,
+                  svd_solver=choose_svd_solver(data.shape[0], data.shape[1],
+                                               pca_dims))
+        compressed = pca.fit_transform(data.to_numpy(copy=False))
     else:
-        compressed = data.values
+        compressed = data.to_numpy(copy=False)
 
     print("Performing tSNE")
     tsne = TSNE(2, perplexity=perplexity, learning_rate=learning_rate,
@@ -293,10 +369,12 @@ def umap_transform(data, field_info,
     if pca_dims is not None and pca_dims < data.shape[1] and pca_dims < data.shape[0]:
         print("Carrying out PCA prior to UMAP: {} -> {}".format(data.shape[1],
                                                                 pca_dims))
-        pca = PCA(pca_dims)
-        compressed = pca.fit_transform(data.values)
+        pca = PCA(pca_dims,
+                  svd_solver=choose_svd_solver(data.shape[0], data.shape[1],
+                                               pca_dims))
+        compressed = pca.fit_transform(data.to_numpy(copy=False))
     else:
-        compressed = data.values
+        compressed = data.to_numpy(copy=False)
 
     print("Performing UMAP")
 